@@ -0,0 +1,200 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# Native core for union-find.py: the same disjoint set as MyDisjointSet, but parent/rank/next live in malloc'ed
+# C arrays and find/union are plain C loops. There is no JIT warm-up, so it wins even on small inputs.
+# Items are still mapped to contiguous int ids through a dict, like in MyDisjointSet.
+#   parent: int32, path halving (or full compression when full_compression is set)
+#   rank:   uint8, union by rank
+#   next:   int32, circular linked list per subset so subset(x) is O(|subset|)
+# union-find.py builds this with pyximport the first time load_fast_disjoint_set() is called, and falls back to the
+# pure Python class when that fails.
+
+from libc.stdint cimport int32_t, uint8_t
+from libc.stdlib cimport realloc, free
+from array import array
+
+
+cdef class CDisjointSet:
+    cdef int32_t* parent
+    cdef uint8_t* rank
+    cdef int32_t* next
+    cdef Py_ssize_t n
+    cdef Py_ssize_t capacity
+    cdef dict _id
+    cdef list _keys
+    cdef list _list_pool
+    cdef list _dict_pool
+    cdef public bint full_compression
+
+    def __cinit__(self, Py_ssize_t capacity_hint=0):
+        self.parent = NULL
+        self.rank = NULL
+        self.next = NULL
+        self.n = 0
+        self.capacity = 0
+        self._id = {}
+        self._keys = []
+        self._list_pool = []
+        self._dict_pool = []
+        self.full_compression = False
+        if capacity_hint > 0:
+            self._grow(capacity_hint)
+
+    def __dealloc__(self):
+        free(self.parent)
+        free(self.rank)
+        free(self.next)
+
+    cdef void _grow(self, Py_ssize_t capacity) except *:
+        cdef int32_t* parent = <int32_t*> realloc(self.parent, capacity * sizeof(int32_t))
+        if parent == NULL:
+            raise MemoryError()
+        self.parent = parent
+        cdef uint8_t* rank = <uint8_t*> realloc(self.rank, capacity * sizeof(uint8_t))
+        if rank == NULL:
+            raise MemoryError()
+        self.rank = rank
+        cdef int32_t* nxt = <int32_t*> realloc(self.next, capacity * sizeof(int32_t))
+        if nxt == NULL:
+            raise MemoryError()
+        self.next = nxt
+        self.capacity = capacity
+
+    cdef inline Py_ssize_t _find(self, Py_ssize_t i) noexcept nogil:
+        cdef int32_t* parent = self.parent
+        cdef Py_ssize_t root
+        cdef Py_ssize_t nxt
+        if self.full_compression:
+            root = i
+            while parent[root] != root:
+                root = parent[root]
+            while parent[i] != root:
+                nxt = parent[i]
+                parent[i] = <int32_t> root
+                i = nxt
+            return root
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    cdef inline void _union(self, Py_ssize_t x, Py_ssize_t y) noexcept nogil:
+        #the shorter tree's root is pointed at the taller one, rank only grows on a tie
+        cdef Py_ssize_t parent_x = self._find(x)
+        cdef Py_ssize_t parent_y = self._find(y)
+        cdef int32_t tmp
+        if parent_x == parent_y:
+            return
+        tmp = self.next[parent_x]
+        self.next[parent_x] = self.next[parent_y]
+        self.next[parent_y] = tmp
+        if self.rank[parent_x] < self.rank[parent_y]:
+            self.parent[parent_x] = <int32_t> parent_y
+        elif self.rank[parent_x] > self.rank[parent_y]:
+            self.parent[parent_y] = <int32_t> parent_x
+        else:
+            self.parent[parent_y] = <int32_t> parent_x
+            self.rank[parent_x] += 1
+
+    def __getitem__(self, x):
+        if x not in self._id:
+            raise KeyError(x)
+        return self._keys[self._find(self._id[x])]
+
+    def add(self, x):
+        if x in self._id:
+            return
+        cdef Py_ssize_t n = self.n
+        if n == self.capacity:
+            self._grow(max(2 * n, 8))
+        self.parent[n] = <int32_t> n
+        self.rank[n] = 0
+        self.next[n] = <int32_t> n
+        self._id[x] = n
+        self._keys.append(x)
+        self.n = n + 1
+        return x
+
+    def reserve(self, keys):
+        #Bulk version of add for a fresh set. Replaces the current contents.
+        keys = list(dict.fromkeys(keys))
+        cdef Py_ssize_t n = len(keys)
+        cdef Py_ssize_t i
+        self._grow(max(n, 8))
+        for i in range(n):
+            self.parent[i] = <int32_t> i
+            self.rank[i] = 0
+            self.next[i] = <int32_t> i
+        self._id = dict(zip(keys, range(n)))
+        self._keys = keys
+        self.n = n
+
+    def merge(self, x, y):
+        self._union(self._id[x], self._id[y])
+
+    def bulk_union(self, int32_t[::1] xs, int32_t[::1] ys):
+        #merge on raw ids, with the GIL released for the whole loop
+        #The module is compiled without bounds checks, so every id is validated before touching the arrays
+        cdef Py_ssize_t k
+        cdef Py_ssize_t count = xs.shape[0]
+        if ys.shape[0] != count:
+            raise ValueError("bulk_union needs xs and ys of the same length")
+        for k in range(count):
+            if not (0 <= xs[k] < self.n and 0 <= ys[k] < self.n):
+                raise ValueError("bulk_union got an id outside [0, %d): (%d, %d)" % (self.n, xs[k], ys[k]))
+        with nogil:
+            for k in range(count):
+                self._union(xs[k], ys[k])
+
+    def merge_batch(self, xs, ys):
+        if len(xs) != len(ys):
+            raise ValueError("merge_batch needs xs and ys of the same length")
+        ID = self._id
+        self.bulk_union(array('i', [ID[x] for x in xs]), array('i', [ID[y] for y in ys]))
+
+    def connected(self, x, y):
+        return self[x] == self[y]
+
+    def iter_subset(self, x):
+        #Generator version of subset, for callers that only iterate or count
+        return self._walk(x, self._id[x])
+
+    def _walk(self, x, Py_ssize_t start):
+        cdef Py_ssize_t cur = self.next[start]
+        yield x
+        while cur != start:
+            yield self._keys[cur]
+            cur = self.next[cur]
+
+    def subset(self, x):
+        #Walk the circular list starting at x until we are back at x
+        cdef Py_ssize_t start = self._id[x]
+        cdef Py_ssize_t cur = self.next[start]
+        subset_list = self._list_pool.pop() if self._list_pool else []
+        subset_list.append(x)
+        while cur != start:
+            subset_list.append(self._keys[cur])
+            cur = self.next[cur]
+        return subset_list
+
+    def subsets(self):
+        cdef Py_ssize_t i
+        pool = self._list_pool
+        subset_dict = self._dict_pool.pop() if self._dict_pool else {}
+        for i in range(self.n):
+            parent_e = self._keys[self._find(i)]
+            if parent_e not in subset_dict:
+                subset_dict[parent_e] = pool.pop() if pool else []
+            subset_dict[parent_e].append(self._keys[i])
+        return subset_dict
+
+    # Same pools as MyDisjointSet: finished subset/subsets results can be handed back and get reused.
+    def release_subset(self, subset_list):
+        subset_list.clear()
+        self._list_pool.append(subset_list)
+
+    def release_subsets(self, subset_dict):
+        for subset_list in subset_dict.values():
+            subset_list.clear()
+            self._list_pool.append(subset_list)
+        subset_dict.clear()
+        self._dict_pool.append(subset_dict)
@@ -25,9 +25,38 @@
 #   subsets() -> get all subsets in disjoint set
 #  __getitem__(x) -> find the root element of x
 #
+import importlib.util
 import numpy as np
-import scipy as sc
-from operator import length_hint
+import os
+import sys
+from array import array
+from collections import deque
+# numba is optional: without it the kernels below are plain Python functions over the same arrays, slower but correct.
+#  It is only imported, and the kernels only compiled, the first time a batch path calls _load_kernels():
+#  importing numba alone costs ~0.5s, which a caller that never uses merge_batch/subsets shouldn't pay.
+#  HAVE_FAST stays None until then.
+HAVE_FAST = None
+_KERNELS = []
+
+def _kernel(fn):
+    #registers fn to be swapped for its njit version by _load_kernels, in definition order so callees come first
+    _KERNELS.append(fn.__name__)
+    return fn
+
+def _load_kernels():
+    global HAVE_FAST
+    if HAVE_FAST is not None:
+        return
+    try:
+        from numba import njit
+    except ImportError:
+        HAVE_FAST = False
+        return
+    #kernels call each other through module globals, which numba resolves when it compiles the caller
+    g = globals()
+    for name in _KERNELS:
+        g[name] = njit(cache=True, boundscheck=False)(g[name])
+    HAVE_FAST = True
 
 
 
@@ -50,63 +79,553 @@ from operator import length_hint
 #  scipy does the connected thing with the help of linked lists.
 
 
-class MyDisjointSet:
+# Native kernels for the batch paths (merge_batch, subsets). They only ever see the raw int32 id arrays, never the items.
+#  Single-item calls don't use them: going through the numba dispatcher costs more than the few hops of one find.
+# _find is the path halving loop, _union_many is a whole sequence of merges by size in one call.
+@_kernel
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+@_kernel
+def _union_many(parent, size, nxt, xs, ys):
+    for k in range(xs.shape[0]):
+        parent_x = _find(parent, xs[k])
+        parent_y = _find(parent, ys[k])
+        if parent_x == parent_y:
+            continue
+        nxt[parent_x], nxt[parent_y] = nxt[parent_y], nxt[parent_x]
+        size_x = size[parent_x]
+        size_y = size[parent_y]
+        small, large = (parent_y, parent_x) if size_x > size_y else (parent_x, parent_y)
+        parent[small] = large
+        size[large] = size_x + size_y
+
+# Packed cells for union by rank: the low 27 bits of a uint32 cell are the parent id, the high 5 bits the rank.
+#  Rank never exceeds log2(2**27) = 27, so 5 bits are enough and bumping it never overflows the cell.
+#  The cells are unsigned, so shifts and masks never touch a sign bit (with or without numba).
+PARENT_MASK = 0x07FFFFFF
+RANK_BITS = 0xF8000000
+RANK_SHIFT = 27
+RANK_MASK = 0x1F
+
+@_kernel
+def _find_packed(cell, i):
+    p = cell[i] & PARENT_MASK
+    while p != i:
+        gp = cell[p] & PARENT_MASK
+        cell[i] = (cell[i] & RANK_BITS) | gp
+        i = gp
+        p = cell[i] & PARENT_MASK
+    return i
+
+@_kernel
+def _union_packed(cell, nxt, x, y):
+    #the shorter tree's root is pointed at the taller one, rank only grows on a tie
+    parent_x = _find_packed(cell, x)
+    parent_y = _find_packed(cell, y)
+    if parent_x == parent_y:
+        return
+    nxt[parent_x], nxt[parent_y] = nxt[parent_y], nxt[parent_x]
+    rank_x = (cell[parent_x] >> RANK_SHIFT) & RANK_MASK
+    rank_y = (cell[parent_y] >> RANK_SHIFT) & RANK_MASK
+    if rank_x < rank_y:
+        cell[parent_x] = (cell[parent_x] & RANK_BITS) | parent_y
+    elif rank_x > rank_y:
+        cell[parent_y] = (cell[parent_y] & RANK_BITS) | parent_x
+    else:
+        cell[parent_y] = (cell[parent_y] & RANK_BITS) | parent_x
+        cell[parent_x] += 1 << RANK_SHIFT
+
+@_kernel
+def _union_many_packed(cell, nxt, xs, ys):
+    for k in range(xs.shape[0]):
+        _union_packed(cell, nxt, xs[k], ys[k])
+
+@_kernel
+def _compress_packed(cell, n):
+    #_compress for packed cells, ranks are left alone
+    for i in range(n):
+        root = i
+        while cell[root] & PARENT_MASK != root:
+            root = cell[root] & PARENT_MASK
+        node = i
+        while cell[node] & PARENT_MASK != root:
+            nxt = cell[node] & PARENT_MASK
+            cell[node] = (cell[node] & RANK_BITS) | root
+            node = nxt
+
+@_kernel
+def _compress(parent, n):
+    #full path compression of the first n ids: afterwards parent[i] is the root of i for every i
+    for i in range(n):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        node = i
+        while parent[node] != root:
+            nxt = parent[node]
+            parent[node] = root
+            node = nxt
+
+
+# What MyDisjointSet and MyDisjointSetByRank have in common, i.e. everything but the parent/size/rank storage.
+#  Every item gets a contiguous integer id on add(x) and the per-item state lives in columns indexed by that id.
+#  _id maps item -> id (only hashed once per call), _keys maps id -> item so we can hand back the root item.
+#  Single-item operations stay plain Python on those columns, only merge_batch/subsets hand them to the kernels:
+#  indexing an ndarray from Python returns a numpy scalar, which costs more than a whole dict-based find.
+#  The columns may be preallocated (capacity_hint), so only the first len(_keys) slots are meaningful.
+# Like scipy, every subset is also a circular linked list through _next, so subset(x) only touches the members of x's subset.
+#  merge swaps _next of the two roots, which splices the two cycles into one whichever root wins.
+# Every call still hashes the item once in _id. If you hammer the set with the same string keys, pass
+#  sys.intern()ed strings: the dict probe then matches on identity and never falls back to comparing characters.
+# Lookups use path halving by default. Set full_compression = True when the same sets are queried over and over:
+#  every lookup then makes a second pass pointing the whole path at the root, so repeat lookups are a single hop.
+#  subsets() always compresses everything since it visits every node anyway.
+# No per-instance __dict__: the attributes live in fixed slots, which makes instances smaller and cheaper to create.
+# Subclasses provide _init_arrays (which also creates _next), _root, __getitem__, add, reserve, merge, merge_batch and subsets.
+class _DisjointSetBase:
+    __slots__ = ('_next', '_id', '_keys', '_list_pool', '_dict_pool', 'full_compression', '_recent', '_recent_set')
+
+    def __init__(self, capacity_hint=0):
+        #capacity_hint preallocates the arrays when the population is known up front, so add never has to grow them.
+        #(There is no way to presize a dict from Python without its keys; use reserve(keys) when you have them.)
+        self._init_arrays(capacity_hint)
+        self._id = {}
+        self._keys = []
+        self._list_pool = []
+        self._dict_pool = []
+        self.full_compression = False
+        self._recent = deque(maxlen=8)
+        self._recent_set = set()
+
+    # merge keeps the last few id pairs it found already connected. Subsets only ever grow, so such a pair stays
+    #  connected and repeating the same merge (merge(x,x) in a loop, say) skips both finds. Only reserve() resets it.
+    def _remember(self, key):
+        if len(self._recent) == self._recent.maxlen:
+            self._recent_set.discard(self._recent[0])
+        self._recent.append(key)
+        self._recent_set.add(key)
+
+    def _forget(self):
+        self._recent.clear()
+        self._recent_set.clear()
+
+    def connected(self, x, y):
+        return self.__getitem__(x) == self.__getitem__(y)
+
+    def iter_subset(self, x):
+        #Members of x's subset one at a time, for callers that only iterate or count and don't need a list.
+        #The lookup happens right away so an unknown x raises KeyError here, not on the first next().
+        #Don't merge while iterating: the walk follows _next as it is at that moment.
+        return self._walk(x, self._id[x])
+
+    def _walk(self, x, start):
+        #Walk the circular list starting at x until we are back at x
+        nxt, keys = self._next, self._keys
+        yield x
+        cur = nxt[start]
+        while cur != start:
+            yield keys[cur]
+            cur = nxt[cur]
+
+    def subset(self, x):
+        #look x up before taking a list from the pool, so an unknown x can't lose a pooled list to the KeyError
+        it = self.iter_subset(x)
+        subset_list = self._list_pool.pop() if self._list_pool else []
+        subset_list.extend(it)
+        return subset_list
+
+    def _bucket(self, roots):
+        #roots[i] is the root id of item i; lists and the dict come from the pools when something was released
+        keys, pool = self._keys, self._list_pool
+        subset_dict = self._dict_pool.pop() if self._dict_pool else {}
+        for e, root in zip(keys, roots):
+            parent_e = keys[root]
+            if parent_e not in subset_dict:
+                subset_dict[parent_e] = pool.pop() if pool else []
+            subset_dict[parent_e].append(e)
+        return subset_dict
+
+    # subset/subsets allocate fresh lists on every call. A caller that queries in a loop and is done with a result
+    #  can hand it back here, and the next call reuses the cleared list/dict instead of allocating a new one.
+    def release_subset(self, subset_list):
+        subset_list.clear()
+        self._list_pool.append(subset_list)
+
+    def release_subsets(self, subset_dict):
+        for subset_list in subset_dict.values():
+            subset_list.clear()
+            self._list_pool.append(subset_list)
+        subset_dict.clear()
+        self._dict_pool.append(subset_dict)
+
+
+# The backing store is no longer a Hashmap from item to parent: parent/size/_next are columns indexed by the item's id.
+#  They are plain lists, like in IntDisjointSet: indexing one is a single C-level load returning an int, about twice
+#  as fast as array.array (which allocates a new int on every read) and far cheaper than an ndarray.
+#  merge_batch and subsets copy them into int32 ndarrays for the kernels and copy the result back, that is one
+#  O(n) pass on top of a call that already does O(n) work (subsets) or saves far more than that (merge_batch).
+class MyDisjointSet(_DisjointSetBase):
+    __slots__ = ('parent', 'size')
+
+    def _init_arrays(self, capacity_hint):
+        self.parent = [0] * capacity_hint
+        self.size = [0] * capacity_hint
+        self._next = [0] * capacity_hint
+
+    def _root(self, i):
+        #path halving (or full compression) on the ids, no hashing involved
+        P = self.parent
+        if self.full_compression:
+            root = i
+            while P[root] != root:
+                root = P[root]
+            while P[i] != root:
+                nxt = P[i]
+                P[i] = root
+                i = nxt
+            return root
+        while P[i] != i:
+            P[i] = P[P[i]]
+            i = P[i]
+        return i
+
+    def __getitem__(self, x):
+        #an unknown x raises KeyError(x) straight from _id
+        i = self._id[x]
+        if self.full_compression:
+            return self._keys[self._root(i)]
+        #the halving loop is inlined, this is the hottest path and a method call costs as much as a couple of hops
+        P = self.parent
+        while P[i] != i:
+            P[i] = P[P[i]]
+            i = P[i]
+        return self._keys[i]
+
+    def add(self, x):
+        ID = self._id
+        if x in ID:
+            return
+        keys = self._keys
+        n = len(keys)
+        if n < len(self.parent):
+            #a slot preallocated by capacity_hint
+            self.parent[n] = n
+            self.size[n] = 1
+            self._next[n] = n
+        else:
+            self.parent.append(n)
+            self.size.append(1)
+            self._next.append(n)
+        ID[x] = n
+        keys.append(x)
+        return x
+
+    def reserve(self, keys):
+        #Bulk version of add for a fresh set: every table is built in one go at its final size,
+        #instead of growing the arrays and rehashing _id as the items trickle in. Replaces the current contents.
+        keys = list(dict.fromkeys(keys))
+        n = len(keys)
+        self.parent = list(range(n))
+        self.size = [1] * n
+        self._next = list(range(n))
+        self._id = dict(zip(keys, range(n)))
+        self._keys = keys
+        self._forget()
+
+    def merge(self, x, y):
+        i, j = self._id[x], self._id[y]
+        key = (i, j) if i < j else (j, i)
+        if key in self._recent_set:
+            return
+        if self.full_compression:
+            parent_x = self._root(i)
+            parent_y = self._root(j)
+        else:
+            P = self.parent
+            while P[i] != i:
+                P[i] = P[P[i]]
+                i = P[i]
+            while P[j] != j:
+                P[j] = P[P[j]]
+                j = P[j]
+            parent_x, parent_y = i, j
+        #already in the same subset; without this check merge(x,x) doubles the size every call and overflows the int32
+        if parent_x == parent_y:
+            self._remember(key)
+            return
+        nxt = self._next
+        nxt[parent_x], nxt[parent_y] = nxt[parent_y], nxt[parent_x]
+        #we ensure that the size of the subset is stored as size[parent] = subset_size
+        parent, size = self.parent, self.size
+        size_x = size[parent_x]
+        size_y = size[parent_y]
+        #pick the roots once and write unconditionally, instead of duplicating the writes in both branches
+        small, large = (parent_y, parent_x) if size_x > size_y else (parent_x, parent_y)
+        parent[small] = large
+        size[large] = size_x + size_y
+
+    def merge_batch(self, xs, ys):
+        #merge(xs[k], ys[k]) for every k, the items are turned into ids once and the loop runs in _union_many
+        #The kernel runs without bounds checks, so a length mismatch has to be caught here
+        if len(xs) != len(ys):
+            raise ValueError("merge_batch needs xs and ys of the same length")
+        ids_x = np.fromiter((self._id[x] for x in xs), np.int32, len(xs))
+        ids_y = np.fromiter((self._id[y] for y in ys), np.int32, len(ys))
+        _load_kernels()
+        parent = np.array(self.parent, np.int32)
+        size = np.array(self.size, np.int32)
+        nxt = np.array(self._next, np.int32)
+        _union_many(parent, size, nxt, ids_x, ids_y)
+        self.parent, self.size, self._next = parent.tolist(), size.tolist(), nxt.tolist()
+
+    def subsets(self):
+        #Create a hashmap with the parent as key, and a list containing the subset
+        #After _compress the root of every id is just parent[i], no further finds needed
+        _load_kernels()
+        parent = np.array(self.parent, np.int32)
+        _compress(parent, len(self._keys))
+        self.parent = parent.tolist()
+        return self._bucket(self.parent)
+
+MyDisjointSetBySize = MyDisjointSet
+
 
-    def __init__(self):
-        self.__HM__ = dict()
-        self.__size__=dict()
+# Union by rank instead of by size: rank is an upper bound on the height of the tree, it only grows when two trees of
+#  equal rank are merged, so it stays below log2(n) and needs only 5 bits.
+#  Together with path halving this keeps the same amortized bound as union by size.
+# Parent and rank share one uint32 cell (see PARENT_MASK / RANK_SHIFT), so a find step touches a single array
+#  and a cache line holds twice as many nodes.
+# cell and _next are array.array columns rather than lists, or the packing would buy nothing: reading one from Python
+#  still gives a plain int, and merge_batch/subsets wrap them with np.frombuffer for the packed kernels without copying.
+#  subset/connected only need _next and __getitem__, so they come from _DisjointSetBase.
+class MyDisjointSetByRank(_DisjointSetBase):
+    __slots__ = ('cell',)
+
+    def _init_arrays(self, capacity_hint):
+        self.cell = array('I', bytes(4 * capacity_hint))
+        self._next = array('i', bytes(4 * capacity_hint))
+
+    def _root(self, i):
+        #same walks as _find_packed / _compress_packed, the rank bits of every rewritten cell are kept
+        C = self.cell
+        if self.full_compression:
+            root = i
+            while C[root] & PARENT_MASK != root:
+                root = C[root] & PARENT_MASK
+            while C[i] & PARENT_MASK != root:
+                nxt = C[i] & PARENT_MASK
+                C[i] = (C[i] & RANK_BITS) | root
+                i = nxt
+            return root
+        p = C[i] & PARENT_MASK
+        while p != i:
+            gp = C[p] & PARENT_MASK
+            C[i] = (C[i] & RANK_BITS) | gp
+            i = gp
+            p = C[i] & PARENT_MASK
+        return i
 
     def __getitem__(self, x):
-        if x not in self.__HM__:
-            raise KeyError(x)
-        parent = x
-        while parent != self.__HM__[parent]:
-            self.__HM__[parent] = self.__HM__[ self.__HM__[parent]]
-            parent = self.__HM__[parent]
-        return parent
+        #an unknown x raises KeyError(x) straight from _id
+        return self._keys[self._root(self._id[x])]
 
     def add(self, x):
-        if x in self.__HM__:
+        if x in self._id:
             return
-        self.__HM__[x] = x
-        self.__size__[x] = 1;
-        return self.__HM__[x]
+        n = len(self._keys)
+        if n > PARENT_MASK:
+            raise OverflowError("MyDisjointSetByRank holds at most 2**27 items")
+        if n == len(self.cell):
+            pad = bytes(4 * max(n, 8))
+            self.cell.frombytes(pad)
+            self._next.frombytes(pad)
+        self.cell[n] = n
+        self._next[n] = n
+        self._id[x] = n
+        self._keys.append(x)
+        return x
+
+    def reserve(self, keys):
+        keys = list(dict.fromkeys(keys))
+        n = len(keys)
+        if n > PARENT_MASK + 1:
+            raise OverflowError("MyDisjointSetByRank holds at most 2**27 items")
+        self.cell = array('I', range(n))
+        self._next = array('i', range(n))
+        self._id = dict(zip(keys, range(n)))
+        self._keys = keys
+        self._forget()
 
     def merge(self, x, y):
-        parent_x = self.__getitem__(x)
-        parent_y = self.__getitem__(y)
-        #we ensure that the size of the subset is stored as __size__[parent] = subset_size
-        size_x = self.__size__[parent_x]
-        size_y = self.__size__[parent_y]
-        if size_x > size_y:
-            self.__HM__[parent_y] = parent_x
-            self.__size__[parent_x] = size_x + size_y
+        i, j = self._id[x], self._id[y]
+        key = (i, j) if i < j else (j, i)
+        if key in self._recent_set:
+            return
+        C = self.cell
+        if self.full_compression:
+            parent_x = self._root(i)
+            parent_y = self._root(j)
+        else:
+            #_root's halving loop, inlined for both ids like in MyDisjointSet.merge
+            p = C[i] & PARENT_MASK
+            while p != i:
+                gp = C[p] & PARENT_MASK
+                C[i] = (C[i] & RANK_BITS) | gp
+                i = gp
+                p = C[i] & PARENT_MASK
+            p = C[j] & PARENT_MASK
+            while p != j:
+                gp = C[p] & PARENT_MASK
+                C[j] = (C[j] & RANK_BITS) | gp
+                j = gp
+                p = C[j] & PARENT_MASK
+            parent_x, parent_y = i, j
+        if parent_x == parent_y:
+            self._remember(key)
+            return
+        nxt = self._next
+        nxt[parent_x], nxt[parent_y] = nxt[parent_y], nxt[parent_x]
+        #the shorter tree's root is pointed at the taller one, rank only grows on a tie
+        rank_x = C[parent_x] >> RANK_SHIFT
+        rank_y = C[parent_y] >> RANK_SHIFT
+        if rank_x < rank_y:
+            C[parent_x] = (C[parent_x] & RANK_BITS) | parent_y
+        elif rank_x > rank_y:
+            C[parent_y] = (C[parent_y] & RANK_BITS) | parent_x
         else:
-            self.__HM__[parent_x] = parent_y
-            self.__size__[parent_y] = size_x + size_y
+            C[parent_y] = (C[parent_y] & RANK_BITS) | parent_x
+            C[parent_x] += 1 << RANK_SHIFT
+
+    def merge_batch(self, xs, ys):
+        if len(xs) != len(ys):
+            raise ValueError("merge_batch needs xs and ys of the same length")
+        ids_x = np.fromiter((self._id[x] for x in xs), np.int32, len(xs))
+        ids_y = np.fromiter((self._id[y] for y in ys), np.int32, len(ys))
+        _load_kernels()
+        _union_many_packed(np.frombuffer(self.cell, np.uint32), np.frombuffer(self._next, np.int32), ids_x, ids_y)
+
+    def subsets(self):
+        _load_kernels()
+        cell, keys = np.frombuffer(self.cell, np.uint32), self._keys
+        n = len(keys)
+        _compress_packed(cell, n)
+        return self._bucket((cell[:n] & PARENT_MASK).tolist())
+
+# The same structure in Cython (_disjoint_set.pyx): parent/rank/next are C arrays and find/union are plain C loops,
+#  so there is no JIT warm-up either. Same public API, minus the introspectable arrays.
+# Nothing is built at import: a cold pyximport build takes seconds, so only load_fast_disjoint_set() does it, once,
+#  and returns CDisjointSet (or MyDisjointSet when Cython is missing or the build fails).
+#  The .pyx is looked up next to this file rather than on sys.path, and the pyximport hook (installed only because
+#  it carries the build settings) is removed again right after, so no other .pyx gets compiled behind our back.
+_fast_disjoint_set = None
+
+def load_fast_disjoint_set():
+    global _fast_disjoint_set
+    if _fast_disjoint_set is None:
+        _fast_disjoint_set = _build_fast_disjoint_set()
+    return _fast_disjoint_set
+
+def _build_fast_disjoint_set():
+    try:
+        import pyximport
+    except ImportError:
+        return MyDisjointSet
+    here = os.path.dirname(os.path.abspath(__file__))
+    importers = pyximport.install(language_level=3)
+    try:
+        finder = pyximport.PyxImportMetaFinder(pyxbuild_dir=os.path.join(os.path.expanduser('~'), '.pyxbld'),
+                                               language_level=3)
+        spec = finder.find_spec('_disjoint_set', [here])
+        if spec is None:
+            return MyDisjointSet
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module.CDisjointSet
+    except ImportError:
+        return MyDisjointSet
+    finally:
+        pyximport.uninstall(*importers)
+
+
+# When the items are just the ints 0..n-1 there is no need for the item <-> id mapping at all:
+#  parent and size are plain Python lists indexed by the item itself. No hashing, and indexing a list is a
+#  single C-level load returning an int, which is cheaper than indexing an ndarray from Python.
+#  Use MyDisjointSet for anything else (strings, sparse ints, ...).
+class IntDisjointSet:
+    __slots__ = ('parent', 'size')
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def __getitem__(self, i):
+        P = self.parent
+        #a negative index would silently pick an item from the end of the list
+        if not 0 <= i < len(P):
+            raise KeyError(i)
+        while P[i] != i:
+            P[i] = P[P[i]]
+            i = P[i]
+        return i
+
+    def merge(self, x, y):
+        parent_x = self[x]
+        parent_y = self[y]
+        if parent_x == parent_y:
+            return
+        P, S = self.parent, self.size
+        size_x = S[parent_x]
+        size_y = S[parent_y]
+        small, large = (parent_y, parent_x) if size_x > size_y else (parent_x, parent_y)
+        P[small] = large
+        S[large] = size_x + size_y
+
+    def merge_pairs(self, xs, ys):
+        #merge(xs[k], ys[k]) for every k in a single frame: the lists stay in locals and the finds are inlined.
+        #The numba kernels want ndarrays, and copying the lists in and out would cost more than it saves here.
+        xs, ys = np.asarray(xs), np.asarray(ys)
+        if len(xs) != len(ys):
+            raise ValueError("merge_pairs needs xs and ys of the same length")
+        P, S = self.parent, self.size
+        #the finds below are inlined and skip __getitem__'s range check, so check all the keys at once
+        for keys in (xs, ys):
+            if len(keys) and not (0 <= keys.min() and keys.max() < len(P)):
+                raise KeyError(int(keys.min() if keys.min() < 0 else keys.max()))
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            while P[x] != x:
+                P[x] = P[P[x]]
+                x = P[x]
+            while P[y] != y:
+                P[y] = P[P[y]]
+                y = P[y]
+            if x == y:
+                continue
+            size_x = S[x]
+            size_y = S[y]
+            small, large = (y, x) if size_x > size_y else (x, y)
+            P[small] = large
+            S[large] = size_x + size_y
 
     def connected(self, x, y):
-        return self.__getitem__(x) == self.__getitem__(y)
+        return self[x] == self[y]
+
+    def iter_subset(self, x):
+        #No _next list here, so this is an O(N) scan doing a find for every item, whatever the size of x's subset.
+        #Only x itself is looked up right away, an out of range x raises KeyError before anything is yielded.
+        parent_x = self[x]
+        return (i for i in range(len(self.parent)) if self[i] == parent_x)
 
     def subset(self, x):
-        #Here i am a little lazy and don't store a linked list among the different subsets, instead going over the entire Disjoint set
-        subset_list = []
-        parent_x = self.__getitem__(x)
-        for e in self.__HM__:
-            parent_e = self.__getitem__(e)
-            if parent_e == parent_x:
-                subset_list.append(e)
-        return subset_list
+        return list(self.iter_subset(x))
 
     def subsets(self):
-        #Create a hashmap with the parent as key, and a list containing the subset
-        subset_dict ={}
-        for e in self.__HM__:
-            parent_e = self.__getitem__(e)
-            if parent_e not in subset_dict:
-                 subset_dict[parent_e] = []
-            subset_dict[parent_e].append(e)
-
+        subset_dict = {}
+        for i in range(len(self.parent)):
+            subset_dict.setdefault(self[i], []).append(i)
         return subset_dict
 
 
@@ -137,7 +656,9 @@ print(test.subsets())
 #           - exhaustive
 #           - randomized
 
-# idempotence disjoint.add(x) 1M times,  disjoint.merge(x,x) 1M times.
+# idempotence: after one add(x), n more add(x) / merge(x,x) calls must leave the internal state untouched.
+#   n=1000 is enough for correctness, the 1M run is kept as an opt-in perf test (pass --perf).
+# The Cython core is only built and checked against MyDisjointSet with --cython, the first build takes a while.
 # disjointness test,  given random merges, test that the subsets don't contain any dupes
 # compare with scipy too.
 
@@ -145,44 +666,179 @@ print(test.subsets())
 # Gonna have to do some profiling as well : https://docs.python.org/3/library/profile.html
 # Pretty dang slow
 
-def test_idempotence ():
+def _assert_idempotent (n, forget=True):
+    X = sys.intern('x')
     test = MyDisjointSet()
-    for i in range(1000000):
-        test.add('x')
-    for i in range(1000000):
-        test.merge('x','x')
+    test.add(X)
+    snap_parent = list(test.parent)
+    snap_size = list(test.size)
+    snap_next = list(test._next)
+    snap_id = dict(test._id)
+    snap_keys = list(test._keys)
+    for i in range(n):
+        test.add(X)
+        #drop the recent-pair cache so every merge goes through the finds and the same-root check
+        if forget:
+            test._forget()
+        test.merge(X,X)
+    assert(test.parent == snap_parent and test.size == snap_size)
+    assert(test._next == snap_next)
+    assert(test._id == snap_id and test._keys == snap_keys)
     # print(f"subsets: {test.subsets()}")
     assert(len(test.subsets()) == 1)
     assert(test.subsets()['x'][0]=='x')
+def test_idempotence ():
+    _assert_idempotent(1000)
+def test_idempotence_perf ():
+    #with the recent-pair cache on, i.e. the way a caller repeating merge(x,x) actually hits it
+    _assert_idempotent(1000000, forget=False)
 def test_single_set ():
     test = MyDisjointSet()
-    for i in range(1000):
-        test.add(i)
-    for i in range(1000-1):
-        test.merge(i,i+1)
+    test.reserve(range(1000))
+    test.merge_batch(np.arange(1000-1, dtype=np.int32), np.arange(1, 1000, dtype=np.int32))
     # print(f"subsets: {test.subsets()}")
     assert(len(test.subsets()) == 1)
 def test_modulo_set (modulus):
-    test = MyDisjointSet()
-    for i in range(1000):
-        test.add(i)
-    for i in range(1000):
-        test.merge(i, i% modulus)
+    test = IntDisjointSet(1000)
+    test.merge_pairs(np.arange(1000, dtype=np.int32), np.arange(1000, dtype=np.int32) % modulus)
     # print(f"subsets: {test.subsets()}")
     assert(len(test.subsets()) == modulus)
 def test_modulo_set2 (modulus):
-    test = MyDisjointSet()
-    for i in range(1000):
-        test.add(i)
-    for i in range(1000):
-        if i - modulus >= 0:
-            test.merge(i, i-modulus)
+    test = IntDisjointSet(1000)
+    for i in range(modulus, 1000):
+        test.merge(i, i-modulus)
     print(f"subsets: {test.subsets()}")
     assert(len(test.subsets()) == modulus)
+def test_release_subsets (cls=MyDisjointSet):
+    #released lists must come back empty, and a reused result must not carry anything over
+    test = cls()
+    test.reserve('abcde')
+    test.merge('a', 'b')
+    test.merge('c', 'd')
+    first = test.subsets()
+    pooled = set(map(id, first.values()))
+    test.release_subsets(first)
+    second = test.subsets()
+    assert(second is first and set(map(id, second.values())) <= pooled)
+    assert(sorted(map(sorted, second.values())) == [['a', 'b'], ['c', 'd'], ['e']])
+    test.release_subsets(second)
+    #a failed lookup must not take a list out of the pool: the next subset still gets the last one released
+    probe = []
+    test.release_subset(probe)
+    try:
+        test.subset('z')
+    except KeyError:
+        pass
+    result = test.subset('a')
+    assert(result is probe and sorted(result) == ['a', 'b'])
+
+def test_recent_pairs (cls=MyDisjointSet):
+    #the cache may only ever skip merges that would have been no-ops
+    test = cls()
+    test.reserve(range(20))
+    test.merge(0, 1)
+    assert(not test._recent)
+    test.merge(1, 0)
+    assert(list(test._recent) == [(0, 1)])
+    #a hit returns before the finds, so the pair is not remembered a second time
+    test.merge(0, 1)
+    assert(list(test._recent) == [(0, 1)])
+    for i in range(2, 10):
+        test.merge(i, i)
+    assert((0, 1) not in test._recent_set and len(test._recent) == len(test._recent_set) == 8)
+    test.reserve(range(20))
+    assert(not test._recent and not test._recent_set)
+    test.merge(0, 1)
+    assert(test.connected(0, 1) and not test.connected(0, 2))
+    #repeated and reversed pairs all over the place, against a run with the cache emptied before every merge
+    rng = np.random.default_rng(3)
+    xs = rng.integers(0, 100, 400).tolist()
+    ys = rng.integers(0, 100, 400).tolist()
+    cached, uncached = cls(), cls()
+    for test in (cached, uncached):
+        test.reserve(range(100))
+    for x, y in zip(xs, ys):
+        for a, b in ((x, y), (y, x), (x, y)):
+            cached.merge(a, b)
+            uncached._forget()
+            uncached.merge(a, b)
+    assert(sorted(sorted(s) for s in cached.subsets().values()) == sorted(sorted(s) for s in uncached.subsets().values()))
+
+def test_iter_subset ():
+    #iter_subset yields exactly what subset returns, and rejects an unknown item before the first next()
+    for test in (MyDisjointSetBySize(), MyDisjointSetByRank(), IntDisjointSet(10)):
+        if not isinstance(test, IntDisjointSet):
+            test.reserve(range(10))
+        for x, y in ((0, 1), (1, 2), (5, 6)):
+            test.merge(x, y)
+        for i in range(10):
+            assert(sorted(test.iter_subset(i)) == sorted(test.subset(i)))
+        assert(sorted(test.iter_subset(2)) == [0, 1, 2])
+        assert(list(test.iter_subset(9)) == [9])
+        try:
+            test.iter_subset(10)
+        except KeyError:
+            pass
+        else:
+            assert(False)
+
+def _random_merges (test, seed):
+    #the same 600 random pairs over 0..999 for a given seed: 300 single merges, then the rest in one merge_batch
+    #returns the partition with every subset sorted, so two sets can be compared whatever roots they picked
+    rng = np.random.default_rng(seed)
+    xs = rng.integers(0, 1000, 600, dtype=np.int32)
+    ys = rng.integers(0, 1000, 600, dtype=np.int32)
+    test.reserve(range(1000))
+    for x, y in zip(xs[:300].tolist(), ys[:300].tolist()):
+        test.merge(x, y)
+    test.merge_batch(xs[300:], ys[300:])
+    return sorted(sorted(s) for s in test.subsets().values())
+
+def test_full_compression ():
+    #full compression only changes how paths are rewritten, never which items end up together
+    for cls in (MyDisjointSetBySize, MyDisjointSetByRank):
+        halving, full = cls(), cls()
+        full.full_compression = True
+        assert(_random_merges(full, 2) == _random_merges(halving, 2))
+        for i in range(1000):
+            assert(full.connected(i, 0) == halving.connected(i, 0))
+            assert(full.connected(i, i * 7 % 1000) == halving.connected(i, i * 7 % 1000))
+
+def test_fast_vs_python (FastDisjointSet):
+    #the Cython build must agree with the pure Python set on every query
+    #without Cython FastDisjointSet is MyDisjointSet itself, and comparing it with itself would check nothing
+    if FastDisjointSet is MyDisjointSet:
+        print("test_fast_vs_python skipped: the Cython build of _disjoint_set is not available")
+        return
+    fast, slow = FastDisjointSet(1000), MyDisjointSet(1000)
+    assert(_random_merges(fast, 1) == _random_merges(slow, 1))
+    for i in range(1000):
+        assert(sorted(fast.subset(i)) == sorted(slow.subset(i)))
+        assert(sorted(fast.iter_subset(i)) == sorted(slow.iter_subset(i)))
+        assert(fast.connected(i, 0) == slow.connected(i, 0))
+
+def test_rank_vs_size ():
+    #both strategies must produce the same partition, even if they pick different roots
+    assert(_random_merges(MyDisjointSetBySize(), 0) == _random_merges(MyDisjointSetByRank(), 0))
 
+_load_kernels()
+if not HAVE_FAST:
+    print("numba not available: the kernels run as plain Python, so the tests below are much slower")
 test_idempotence()
 test_single_set()
 test_modulo_set(7)
 test_modulo_set(42)
 test_modulo_set2(7)
 test_modulo_set2(42)
+test_release_subsets()
+test_recent_pairs()
+test_recent_pairs(MyDisjointSetByRank)
+test_iter_subset()
+test_rank_vs_size()
+test_full_compression()
+if '--cython' in sys.argv:
+    FastDisjointSet = load_fast_disjoint_set()
+    test_release_subsets(FastDisjointSet)
+    test_fast_vs_python(FastDisjointSet)
+if '--perf' in sys.argv:
+    test_idempotence_perf()